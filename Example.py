@@ -5,7 +5,12 @@
 
 #First tell the system where to find the modules:
 import sys,os
-from ConfigParser import SafeConfigParser
+try:
+    from ConfigParser import SafeConfigParser
+except ImportError:  # Python 3 (inline comments are only stripped if their prefixes are given)
+    from configparser import ConfigParser
+    def SafeConfigParser():
+        return ConfigParser(inline_comment_prefixes=(';',))
 import logging as logger
 
 
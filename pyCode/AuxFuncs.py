@@ -11,37 +11,84 @@
 """
 
 import os
-from scipy import integrate, interpolate, optimize, special
-from numpy import arange, inf
+from scipy import optimize
+from numpy import arange
+import numpy as np
 from math import exp, sqrt, log, pi, log10
 import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 import warnings
 import pickle
+import ast
 Tmin,Tmax = 1e-15,1e5 #min and max values for evaluating gSTAR
+MP = 1.22*10**19  #Planck mass
+rhoRadFactor = pi**2/30  #rho_rad = rhoRadFactor*gSTAR(T)*T**4
+entropyFactor = 2*pi**2/45  #S = entropyFactor*gSTARS(T)*T**3
+
+#SM masses and degrees of freedom (positive/negative for bosons/fermions) used by gSTARexact:
+#W, Z, A, electron, muon, tau, neutrino
+MassesGauge = [80., 91., 0.]
+DoFGauge = [6, 3, 2]
+MassesLeptons = [0.51*10.**(-3), 0.1056, 1.77, 0.]
+DoFLeptons = [-4, -4, -4, -6]
+#Before QCD phase transition: u, d, s, c, b, t, g
+MassesQuarks = [3.*10**(-3), 5.*10**(-3), 0.1, 1.3, 4.2, 173.3, 0.]
+DoFQuarks = [-12, -12, -12, -12, -12, -12, 16]
+#After QCD phase transition: pion, eta, rho, omega, kaon
+MassesHadrons = [0.14, 0.55, 0.77, 0.78, 0.5]
+DoFHadrons = [4, 2, 6, 6, 4]
+MassesSMhot = np.array(MassesGauge + MassesLeptons + MassesQuarks)
+DoFSMhot = np.array(DoFGauge + DoFLeptons + DoFQuarks)
+MassesSMcold = np.array(MassesGauge + MassesLeptons + MassesHadrons)
+DoFSMcold = np.array(DoFGauge + DoFLeptons + DoFHadrons)
+MassNeutrino, DoFNeutrino = 0., -6
 
 warnings.filterwarnings('error')
 
 
 class interp1d_picklable:
     """
-    class wrapper for piecewise linear function. Required for pickling a interp1d result.
+    class wrapper for piecewise linear function. Required for pickling the interpolation.
+    The interpolation is evaluated with numpy.interp, which has a much lower overhead than
+    interpolate.interp1d for scalar inputs. The keyword arguments follow the interp1d conventions:
+    fill_value can be a (below,above) tuple or 'extrapolate' (linear extrapolation using the end points).
+    If fill_value is not given, the end point values are used outside the interpolation range.
     """
     def __init__(self, xi, yi, **kwargs):
         self.xi = xi
         self.yi = yi
         self.args = kwargs
-        self.f = interpolate.interp1d(xi, yi, **kwargs)
+        self.setInterpolation()
+
+    def setInterpolation(self):
+        """Sets the arrays and boundary values used by numpy.interp"""
+        
+        isort = np.argsort(self.xi)
+        self.x = np.asarray(self.xi,dtype=float)[isort]
+        self.y = np.asarray(self.yi,dtype=float)[isort]
+        fill_value = self.args.get('fill_value',(self.y[0],self.y[-1]))
+        self.extrapolate = isinstance(fill_value,str) and fill_value == 'extrapolate'
+        if self.extrapolate:
+            self.left,self.right = self.y[0],self.y[-1]
+            self.slopeLeft = (self.y[1]-self.y[0])/(self.x[1]-self.x[0])
+            self.slopeRight = (self.y[-1]-self.y[-2])/(self.x[-1]-self.x[-2])
+        else:
+            self.left,self.right = fill_value
 
     def __call__(self, xnew):
-        return self.f(xnew)
+        ynew = np.interp(xnew, self.x, self.y, left=self.left, right=self.right)
+        if self.extrapolate:
+            ynew = np.where(xnew < self.x[0], self.y[0] + self.slopeLeft*(xnew-self.x[0]), ynew)
+            ynew = np.where(xnew > self.x[-1], self.y[-1] + self.slopeRight*(xnew-self.x[-1]), ynew)
+        return ynew
 
     def __getstate__(self):
         return self.xi, self.yi, self.args
 
     def __setstate__(self, state):
-        self.f = interpolate.interp1d(state[0], state[1], **state[2])
+        self.xi, self.yi, self.args = state
+        self.setInterpolation()
         
 def printParameters(parameters,outFile=None):
     """
@@ -50,12 +97,12 @@ def printParameters(parameters,outFile=None):
     :param parameters: dictionary with parameters labels and their values
     """        
     if outFile:
-        f = open(outFile,'a')
-        f.write('#-------------\n')
-        f.write('# Parameters:\n')
-        for par,val in sorted(parameters):
-            f.write('# %s = %s\n' %(par,val))
-        f.write('#-------------\n')            
+        with open(outFile,'a') as f:
+            f.write('#-------------\n')
+            f.write('# Parameters:\n')
+            for par,val in sorted(parameters):
+                f.write('# %s = %s\n' %(par,val))
+            f.write('#-------------\n')            
   
         
 def printSummary(compList,TF,outFile=None):
@@ -63,7 +110,7 @@ def printSummary(compList,TF,outFile=None):
     Prints basic summary of solutions.
     """
     #Solution summary:
-    if isinstance(outFile,file):
+    if hasattr(outFile,'write'):
         f = outFile    
     else:    
         f = open(outFile,'a')
@@ -72,10 +119,9 @@ def printSummary(compList,TF,outFile=None):
     f.write('# Summary\n')
     f.write('# TF=%s\n' %TF)
     for comp in compList:         
-        mindelta, Tlast = None, TF
+        Tlast = TF
         if comp.Tdecay: Tlast = max(comp.Tdecay,TF)    
-        for iT,T in enumerate(comp.evolveVars['T']):   #Get point closest to Tlast        
-            if abs(T-Tlast) < mindelta or mindelta is None: iF, mindelta = iT, abs(T-Tlast)
+        iF = int(np.argmin(np.abs(np.asarray(comp.evolveVars['T'])-Tlast)))   #Get point closest to Tlast
         rhoF = comp.evolveVars['rho'][iF]
         nF = comp.evolveVars['n'][iF]
         Tfinal = comp.evolveVars['T'][iF]        
@@ -88,6 +134,7 @@ def printSummary(compList,TF,outFile=None):
     
     f.write('# Delta Neff (@TF) = %s\n' %sum([getDNeff(comp,TF) for comp in compList]))
     f.write('#-------------\n')
+    if f is not outFile: f.close()  #Only close the file if it was opened here
 
 
 def printData(compList,outputFile=None):
@@ -96,22 +143,40 @@ def printData(compList,outputFile=None):
     """
     
     if outputFile:
-        f = open(outputFile,'a')
-        f.write('#-------------\n')
-        f.write('# Header:\n')
         header = ['R','T (GeV)']
         for comp in compList:
             header += ['n_{%s} (GeV^{3})'%comp.label, '#rho_{%s} (GeV^{2})' %comp.label]
         maxLength = max([len(s) for s in header])
         line = ' '.join(str(x).center(maxLength) for x in header)
-        f.write('# '+line+'\n')
-        for i,R in enumerate(compList[0].evolveVars['R']):
-            data = [R,compList[0].evolveVars['T'][i]]
-            for comp in compList:
-                data += [comp.evolveVars['n'][i],comp.evolveVars['rho'][i]]
-            line = ' '.join(str('%.4E'%x).center(maxLength) for x in data)
-            f.write(line+'\n')
-        f.write('#-------------\n')
+#Fill the table columns directly (without building an intermediate list of columns):
+        data = np.empty((len(compList[0].evolveVars['T']),len(header)))
+        data[:,0] = compList[0].evolveVars['R']
+        data[:,1] = compList[0].evolveVars['T']
+        for icomp,comp in enumerate(compList):
+            data[:,2+2*icomp] = comp.evolveVars['n']
+            data[:,3+2*icomp] = comp.evolveVars['rho']
+        with open(outputFile,'a') as f:
+            f.write('#-------------\n')
+            f.write('# Header:\n')
+            f.write('# '+line+'\n')
+            np.savetxt(f,data,fmt='%'+str(maxLength)+'.4E',delimiter=' ')
+            f.write('#-------------\n')
+
+def getValueFrom(val):
+    """
+    Converts a string read from a datafile to its value (number, None, ...).
+    If it can not be converted, returns the stripped string.
+    """
+    
+    val = val.strip()
+    try:
+        return ast.literal_eval(val)
+    except (ValueError, SyntaxError):
+        pass
+    try:
+        return float(val)  #Accepts inf and nan
+    except ValueError:
+        return val
 
 def getDataFrom(dataFile):    
     """
@@ -123,8 +188,8 @@ def getDataFrom(dataFile):
         logger.error('File %s not found' %dataFile)
         return None,None,None
     
-    f = open(dataFile,'r')
-    data = f.read()
+    with open(dataFile,'r') as f:
+        data = f.read()
     
     #Get parameters
     parDict = {}
@@ -134,10 +199,7 @@ def getDataFrom(dataFile):
         for par in parameters:
             if not '=' in par: continue
             parameter,val = par.split('=')
-            val = val.replace('\n','')
-            try:
-                val = eval(val)
-            except: pass
+            val = getValueFrom(val)
             parameter = parameter.replace('#','').strip()
             parDict[parameter] = val
             
@@ -151,7 +213,7 @@ def getDataFrom(dataFile):
             if not '=' in par: continue
             if par.count('=') == 1:
                 par = par.split('=')
-                summaryDict[par[0].strip()] = eval(par[1])
+                summaryDict[par[0].strip()] = getValueFrom(par[1])
             elif '|' in par and ':' in par:
                 compLabel = par.split(':')[0]
                 summaryDict[compLabel] = {}
@@ -159,10 +221,7 @@ def getDataFrom(dataFile):
                 for v in vals:
                     label,val = v.split('=')
                     label = label.strip()
-                    try:
-                        val = eval(val)
-                    except:
-                        val = val.strip()
+                    val = getValueFrom(val)
                     summaryDict[compLabel][label] = val            
 
     #Get data
@@ -173,19 +232,12 @@ def getDataFrom(dataFile):
         header = dataPts.split('\n')[1]
         header = header.split('  ')
         header = [h.strip() for h in header if h.replace('#','').strip()]
-        dataDict = dict([[h,[]] for h in header])
     
-        #Get data points    
-        pts = dataPts.split('\n')[2:]
-    
-        for pt in pts:
-            pt = pt.replace('#','')
-            if not pt.strip():
-                continue
-            pt = pt.split(' ')
-            pt = [eval(x) for x in pt if x.strip()]
-            for i,val in enumerate(pt):
-                dataDict[header[i]].append(val)
+        #Get data points (np.loadtxt warns if there are none)
+        rows = [l for l in dataPts.split('\n')[2:] if l.strip() and not l.strip().startswith('#')]
+        if rows: pts = np.loadtxt(rows,comments='#',ndmin=2)
+        else: pts = np.zeros((0,len(header)))
+        dataDict = dict([[h,pts[:,i]] for i,h in enumerate(header)])
 
     return parDict,summaryDict,dataDict
 
@@ -200,7 +252,7 @@ def getOmega(comp,rho,n,T):
     rhoh2 = 8.0992*10.**(-47)   # value of rho critic divided by h^2
     dx = (1./3.)*log(gSTARS(T)/gSTARS(Ttoday)) + log(T/Ttoday)   #dx = log(R/R_today), where R is the scale factor
     nToday = n*exp(-3.*dx)
-    ns = log((2*pi**2/45)*T**3)  #entropy (constant) 
+    ns = log(entropyFactor*T**3)  #entropy (constant) 
     
     if comp.Type == 'CO': return nToday*comp.mass(Ttoday)/rhoh2  #CO components have trivial (non-relativistic) solution 
                
@@ -216,7 +268,16 @@ def getOmega(comp,rho,n,T):
             nF = n*exp(-3*x)   #Number density at x (decoupled solution)
             rhoF = R*nF         #Energy density at x                        
             return -3*getPressure(comp.mass(TF),rhoF,nF)/nF
-        RToday = integrate.odeint(Rfunc, R0, [0.,24.], atol = comp.mass(Ttoday)/10.)[1][0]  #Solve decoupled ODE for R=rho/n
+        #Solve decoupled ODE for R=rho/n (smooth and non-stiff, so a fixed step RK4 is enough)
+        xpts = np.linspace(0.,24.,200)
+        h = xpts[1]-xpts[0]
+        RToday = R0
+        for x in xpts[:-1]:
+            k1 = Rfunc(RToday,x)
+            k2 = Rfunc(RToday+h*k1/2.,x+h/2.)
+            k3 = Rfunc(RToday+h*k2/2.,x+h/2.)
+            k4 = Rfunc(RToday+h*k3,x+h)
+            RToday += h*(k1+2.*k2+2.*k3+k4)/6.
    
     return RToday*nToday/rhoh2
 
@@ -228,8 +289,7 @@ def getDNeff(comp,TF):
 #Ignore component if it has decayed before TF        
     if comp.Tdecay and comp.Tdecay > TF: return 0.
 #Get the number and energy densities of comp at T:
-    Tdelta = [abs(TF-T) for T in comp.evolveVars['T']]
-    iF = Tdelta.index(min(Tdelta))    
+    iF = int(np.argmin(np.abs(np.asarray(comp.evolveVars['T'])-TF)))
     rho = comp.evolveVars['rho'][iF]
     n = comp.evolveVars['n'][iF]
     T = comp.evolveVars['T'][iF]
@@ -243,61 +303,108 @@ def getDNeff(comp,TF):
 def Hfunc(T, rhov, sw):
     """Compute the Hubble parameter, given the variables x=log(R/R0) and ni, rhoi and NS=log(S/S0) """
     
-    MP = 1.22*10**19
-    
-    rhoActive = []
-    for i, rho in enumerate(rhov):
-        if not sw[i]: continue
-        rhoActive.append(rho)  # energy density of each active component     
-    rhoRad = (pi**2/30)*gSTAR(T)*T** 4  # thermal bath's energy density    
-    rhoActive.append(rhoRad)
-    rhoTot = sum(rhoActive)  # Total energy density    
+    rhoActive = np.asarray(rhov)[np.asarray(sw,dtype=bool)]  # energy density of each active component
+    rhoRad = rhoRadFactor*gSTAR(T)*T**4  # thermal bath's energy density    
+    rhoTot = rhoActive.sum() + rhoRad  # Total energy density    
     H = sqrt(8*pi*rhoTot/3)/MP
     
     return H
 
 
+def gSTARpoints(Tpts):
+    """
+    Computes g*(T) and g*s(T) at the temperatures Tpts.
+    gSTARSexact is evaluated right after gSTARexact, so it reuses the cached gSTARexact values.
+    """
+    
+    return [(float(gSTARexact(T)),float(gSTARSexact(T))) for T in Tpts]
+
 def getFunctions(pclFile):
     """
     Computes the g*(T), g*s(T) and temperature functions and saves
-    them to a pickle file. Ignores all BSM effects to these functions
+    them to a pickle file. Ignores all BSM effects to these functions.
+    The points used for the interpolation are also stored in a .npz file
+    (with the same name as the pickle file), so the functions can be rebuilt
+    without recomputing g*(T) and g*s(T).
     :param pclFile: Name of pickle file to dump the functions
     """
     
-    logger.info("Computing auxiliary functions. This calculation is done only once and the results will be stored in %s.\n" %pclFile)
-    
-    #Get points to evaluate gSTAR
-    Tpts = [10**i for i in arange(log10(Tmin),log10(Tmax),0.01)]
-    #Evaluate gSTAR and gSTARS at these points
-    gSTARpts = [gSTARexact(T) for T in Tpts]
-    gSTARSpts = [gSTARSexact(T) for T in Tpts]
+    npzFile = os.path.splitext(pclFile)[0]+'.npz'
+    if os.path.isfile(npzFile):
+        logger.info("Building auxiliary functions from the points stored in %s.\n" %npzFile)
+        pts = np.load(npzFile)
+        Tpts = list(pts['Tpts'])
+        gSTARpts = list(pts['gSTAR'])
+        gSTARSpts = list(pts['gSTARS'])
+    else:
+        logger.info("Computing auxiliary functions. This calculation is done only once and the results will be stored in %s.\n" %pclFile)
+        #Get points to evaluate gSTAR
+        Tpts = [10**i for i in arange(log10(Tmin),log10(Tmax),0.01)]
+        #Evaluate gSTAR and gSTARS at these points:
+        res = gSTARpoints(Tpts)
+        gSTARpts = [r[0] for r in res]
+        gSTARSpts = [r[1] for r in res]
+        np.savez(npzFile,Tpts=Tpts,gSTAR=gSTARpts,gSTARS=gSTARSpts)
     #Get interpolating functions:
     gSTAR = interp1d_picklable(Tpts,gSTARpts,fill_value = (gSTARpts[0],gSTARpts[-1]),
                                bounds_error=False)
     gSTARS = interp1d_picklable(Tpts,gSTARSpts,fill_value = (gSTARSpts[0],gSTARSpts[-1]),
                                bounds_error=False)
     #Evaluate (2*pi^2/45)*gstarS(T)*T^3 at these points:
-    fpts = [log((2*pi**2/45.)*gSTARS(T)*T**3) for T in Tpts]
+    fpts = [log(entropyFactor*gSTARS(T)*T**3) for T in Tpts]
     #Get inverse function to compute temperature from 
     Tfunc =  interp1d_picklable(fpts,Tpts,fill_value='extrapolate')    
-    f = open(pclFile,'w')
-    pickle.dump(gSTAR,f)
-    pickle.dump(gSTARS,f)
-    pickle.dump(Tfunc,f)
-    f.close()
+    with open(pclFile,'wb') as f:
+        pickle.dump(gSTAR,f,protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump(gSTARS,f,protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump(Tfunc,f,protocol=pickle.HIGHEST_PROTOCOL)
+
+def loadFunctions(pclFile):
+    """
+    Loads the g*(T), g*s(T) and temperature functions stored by getFunctions.
+    If the pickle file does not exist or can not be read (e.g. it was written
+    by a different version of Python/SciPy), the functions are rebuilt.
+    :param pclFile: Name of pickle file with the functions
+    :return: gSTAR, gSTARS and Tfunc
+    """
+    
+    if not os.path.isfile(pclFile):
+        getFunctions(pclFile)
+    
+    logger.info("Loading aux functions. Ignoring BSM corrections to g* and g*_S")
+    try:
+        with open(pclFile,'rb') as f:
+            return pickle.load(f),pickle.load(f),pickle.load(f)
+    except Exception:
+        logger.warning("Could not read %s. The auxiliary functions will be rebuilt." %pclFile)
+        getFunctions(pclFile)
+        with open(pclFile,'rb') as f:
+            return pickle.load(f),pickle.load(f),pickle.load(f)
 
 def getTemperature(x,NS):
+    """
+    Computes the temperature of the thermal bath for x = log(R/R0) and NS = log(S/S0).
+    x and NS can also be arrays, in which case an array of temperatures is returned.
+    """
     
-    xmin = log((2*pi**2/45.)*gSTARS(Tmin)*Tmin**3)
-    xmax = log((2*pi**2/45.)*gSTARS(Tmax)*Tmax**3)
     xeff = NS - 3.*x
-    if xeff < xmin:  #For T < Tmin, g* is constant
-        return ((45./(2*pi**2))*exp(xeff)/gSTARS(Tmin))**(1./3.)
-    elif xeff > xmax: #For T > Tmax, g* is constant
-        return ((45./(2*pi**2))*exp(xeff)/gSTARS(Tmax))**(1./3.)
+    if np.ndim(xeff) > 0:
+        xeff = np.asarray(xeff,dtype=float)
+        T = Tfunc(xeff)
+        T = np.where(xeff < xeffMin,(np.exp(xeff)/(entropyFactor*gSTARSmin))**(1./3.),T)
+        T = np.where(xeff > xeffMax,(np.exp(xeff)/(entropyFactor*gSTARSmax))**(1./3.),T)
+        return T
+    if xeff < xeffMin:  #For T < Tmin, g* is constant
+        return (exp(xeff)/(entropyFactor*gSTARSmin))**(1./3.)
+    elif xeff > xeffMax: #For T > Tmax, g* is constant
+        return (exp(xeff)/(entropyFactor*gSTARSmax))**(1./3.)
     else:    
         return Tfunc(xeff)
 
+# Expansion coefficients for relativistic/non-relativistic transition (used by getPressure)
+aV = [-0.345998, 0.234319, -0.0953434, 0.023657, -0.00360707, 0.000329645, -0.0000165549, 3.51085*10.**(-7)]
+aVreversed = aV[::-1]
+
 def getPressure(mass, rho, n):
     """Computes the pressure for a component, given its mass, its energy density and its number density"""
 
@@ -305,34 +412,75 @@ def getPressure(mass, rho, n):
     if R > 11.5*mass: return n*(R/3)  # Ultra relativistic limit
     if R <= mass: return 0.  # Ultra non-relativistic limit
     
-# Expansion coefficients for relativistic/non-relativistic transition    
-    aV = [-0.345998, 0.234319, -0.0953434, 0.023657, -0.00360707, 0.000329645, -0.0000165549, 3.51085*10.**(-7)]    
+    u = R/mass - 1.
     Prel = n*(R/3)  # Relativistic pressure
-    Pnonrel = (2.*mass/3.)*(R/mass - 1.)  # Non-relativistic pressure
-    Pnonrel += mass*sum([ai*(R/mass - 1.)**(i+2)  for i, ai in enumerate(aV)])
+    aSum = 0.  # sum_i aV[i]*u**i (using Horner's scheme)
+    for ai in aVreversed:
+        aSum = aSum*u + ai
+    Pnonrel = (2.*mass/3.)*u + mass*aSum*u**2  # Non-relativistic pressure
     Pnonrel *= n
         
     return min(Prel, Pnonrel)  # If P2 > P1, it means ultra relativistic limit applies -> use P1
 
+def getPressureDerivative(mass, rho, n):
+    """Computes the derivative of the pressure with respect to R = rho/n (at fixed n) for a component,
+    given its mass, its energy density and its number density (see getPressure)"""
+
+    R = rho/n    
+    if R > 11.5*mass: return n/3.  # Ultra relativistic limit
+    if R <= mass: return 0.  # Ultra non-relativistic limit
+    
+    u = R/mass - 1.
+    aSum, daSum = 0., 0.  # sum_i aV[i]*u**i and its derivative (using Horner's scheme)
+    for ai in aVreversed:
+        daSum = daSum*u + aSum
+        aSum = aSum*u + ai
+    Prel = n*(R/3)  # Relativistic pressure
+    Pnonrel = n*((2.*mass/3.)*u + mass*aSum*u**2)  # Non-relativistic pressure
+    if Prel <= Pnonrel: return n/3.  # Ultra relativistic limit applies (see getPressure)
+
+    return n*(2./3. + 2.*u*aSum + daSum*u**2)
+
+def gstarIntegrand(u, x, ep):
+    """
+    Integrand for the contribution of a single particle to gSTAR (see gstarFunc),
+    as a function of u = log(y). Accepts arrays (of the same shape or broadcastable) for u, x and ep.
+    """
+    
+    y = np.exp(u)
+    return np.sqrt(1. - y**2*x**2)/(y**4*(np.exp(1./y) + ep))
+
+gaussNodes, gaussWeights = np.polynomial.legendre.leggauss(64)  #Gauss-Legendre points used by gstarFunc (relative error < 1e-4)
+
 def gstarFunc(x, dof):
     """
-    Auxiliary function to compute the contribution from a single particle to gSTAR.\
+    Auxiliary function to compute the contribution from a single particle to gSTAR.
     x = mass/T, dof = number of degrees of freedom (positive/negative for bosons/fermions)
+    x and dof can be arrays (one entry per particle), in which case an array is returned.
     """
-            
-    if x > 20.: res = 0.  # Particle has decoupled
-    elif x > 10.**(-2):  # Near decoupling
-        ep = -float(dof / abs(dof))
+    
+    xs = np.atleast_1d(np.asarray(x,dtype=float))
+    dofs = np.atleast_1d(np.asarray(dof,dtype=float))
+    res = np.where(dofs < 0, 5.6822, 6.49394)  # Fully relativistic/coupled
+    res[xs > 20.] = 0.  # Particle has decoupled
+    near = (xs > 10.**(-2)) & (xs <= 20.)  # Near decoupling
+    if near.any():
+        xn = xs[near]
+        ep = -np.sign(dofs[near])
         epsilon = 0.01  # To avoid limits on end points
-        a = 0. + epsilon
-        b = (1. / x) * (1. - epsilon / 100.)
-        res = integrate.romberg(lambda y: sqrt(1. - y ** 2 * x ** 2) / (y ** 5 * (exp(1. / y) + ep)), a, b,
-                                tol=0., rtol=0.01, divmax=100, vec_func=False)
-    else:
-        if dof < 0: res = 5.6822  # Fully relativistic/coupled
-        elif dof > 0: res = 6.49394
-                        
-    return res*abs(dof)*0.15399  # Result
+        a = log(0. + epsilon)
+        b = np.log((1. / xn) * (1. - epsilon / 100.))
+        #Gauss-Legendre quadrature in log(y) (the integrand is peaked at small y),
+        #evaluated for all particles at once:
+        u = (b - a)*(gaussNodes[:,None] + 1.)/2. + a
+        res[near] = (b - a)/2.*np.sum(gaussWeights[:,None]*gstarIntegrand(u, xn, ep), axis=0)
+    res = res*np.abs(dofs)*0.15399
+    
+    if np.ndim(x) == 0 and np.ndim(dof) == 0:
+        return float(res[0])
+    return res  # Result
+
+gstarCache = {}  #Stores the results from gSTARexact
 
 def gSTARexact(T, interpol=True):
     """
@@ -341,48 +489,40 @@ def gSTARexact(T, interpol=True):
     interpol turns on/off the interpolation around the QCD phase trasition region.
     """
 
-    gstar = 0.
-# Define SM masses and degrees of freedom
-    MassesGauge = {"W" : 80., "Z" : 91., "A" : 0.}
-    DoFGauge = {"W" : 6, "Z" : 3, "A" : 2}
-    MassesLeptons = {"electron" : 0.51 * 10.**(-3), "muon" : 0.1056, "tau" : 1.77, "neutrino" : 0.}
-    DoFLeptons = {"electron" :-4, "muon" :-4, "tau" :-4, "neutrino" :-6}
-    if T < 0.25:  # After QCD phase transition        
-        MassesHadrons = {"pion" : 0.14, "eta" : 0.55, "rho" : 0.77, "omega" : 0.78, "kaon" : 0.5}
-        DoFHadrons = {"pion" : 4, "eta" : 2, "rho" : 6, "omega" : 6, "kaon" : 4}
+    if (T, interpol) in gstarCache: return gstarCache[(T, interpol)]
+
+# Select SM masses and degrees of freedom
+    if T < 0.25:  # After QCD phase transition
+        MassesSM, DoFSM = MassesSMcold, DoFSMcold
     else:  # Before QCD phase transition
-        MassesHadrons = {"u" : 3.*10 ** (-3), "d" : 5.*10 ** (-3), "s" : 0.1, "c" : 1.3, "b" : 4.2, "t" : 173.3,
-                         "g" : 0.}
-        DoFHadrons = {"u" :-12, "d" :-12, "s" :-12, "c" :-12, "b" :-12, "t" :-12, "g" : 16}
-    MassesSM = dict(MassesGauge.items() + MassesLeptons.items() + MassesHadrons.items())
-    DoFSM = dict(DoFGauge.items() + DoFLeptons.items() + DoFHadrons.items())
+        MassesSM, DoFSM = MassesSMhot, DoFSMhot
 # Add up SM degrees of freedom     
-    for part in MassesSM:
-        gstar += gstarFunc(MassesSM[part] / T, DoFSM[part])
+    gstar = float(gstarFunc(MassesSM / T, DoFSM).sum())
 
 # Correct for neutrino decoupling:
     if T <= 5.*10.**(-4):
-        gstar += (-1. + (4. / 11.) ** (4. / 3.)) * gstarFunc(MassesSM["neutrino"] / T, DoFSM["neutrino"]) 
+        gstar += (-1. + (4. / 11.) ** (4. / 3.)) * gstarFunc(MassNeutrino / T, DoFNeutrino)
      
-# Smooth discontinuous transitions:
+# Smooth discontinuous transitions (linear interpolation between the fixed window endpoints):
     if interpol:
 # QCD phase transition:
-        finter = None
-        if 0.15 < T < 0.3 and interpol:
-            Tpts = [0.15, 0.3]
-            gpts = [gSTARexact(Tpt, False) for Tpt in Tpts]        
-            finter = interpolate.interp1d(Tpts, gpts, kind='linear')            
+        if QCDwindow[0] < T < QCDwindow[1]:
+            gstar = float(np.interp(T, QCDwindow, gSTARQCD))
 # Neutrino decoupling            
-        elif  2.*10.**(-4) < T < 6.*10.**(-4):
-            Tpts = [2.*10.**(-4), 6.*10 ** (-4)]
-            gpts = [gSTARexact(Tpt, False) for Tpt in Tpts]        
-            finter = interpolate.interp1d(Tpts, gpts, kind='linear')
-# Replace gstar value by interpolation:
-        if finter:
-            gstar = finter(T)
+        elif NUwindow[0] < T < NUwindow[1]:
+            gstar = float(np.interp(T, NUwindow, gSTARNU))
+    
+    if len(gstarCache) > 4096: gstarCache.clear()  #Keep cache size bounded
+    gstarCache[(T, interpol)] = gstar
     
     return gstar
 
+#Temperature windows where gSTARexact is interpolated and the (non-interpolated) values at their endpoints:
+QCDwindow = [0.15, 0.3]
+NUwindow = [2.*10.**(-4), 6.*10 ** (-4)]
+gSTARQCD = [gSTARexact(Tpt, False) for Tpt in QCDwindow]
+gSTARNU = [gSTARexact(Tpt, False) for Tpt in NUwindow]
+
 def gSTARSexact(T):
     """
     Computes the number of relativistic degrees of freedom for computing the entropy density,\
@@ -414,14 +554,9 @@ def getTexact(x,NS):
 
 
 
-#Load auxiliary (pre-computed) functions:
-
-if not os.path.isfile('gFunctions.pcl'):
-    getFunctions('gFunctions.pcl')
- 
-f = open('gFunctions.pcl','r')
-logger.info("Loading aux functions. Ignoring BSM corrections to g* and g*_S")
-gSTAR = pickle.load(f)
-gSTARS = pickle.load(f)
-Tfunc = pickle.load(f)
-f.close()
+#Load auxiliary (pre-computed) functions (stored in the same folder as this module):
+gSTAR,gSTARS,Tfunc = loadFunctions(os.path.join(os.path.dirname(os.path.abspath(__file__)),'gFunctions.pcl'))
+#Constants used by getTemperature (limits of the range covered by Tfunc):
+gSTARSmin, gSTARSmax = float(gSTARS(Tmin)), float(gSTARS(Tmax))
+xeffMin = log(entropyFactor*gSTARSmin*Tmin**3)
+xeffMax = log(entropyFactor*gSTARSmax*Tmax**3)
@@ -10,17 +10,19 @@
 
 """
 
-from AuxFuncs import Hfunc, getTemperature, getPressure
-from math import exp, log, isnan, pi
+try:
+    from .AuxFuncs import Hfunc, getTemperature, getPressure, getPressureDerivative, MP
+    from .component import getNEQ
+except (ImportError, ValueError):  # When imported as a top-level module
+    from AuxFuncs import Hfunc, getTemperature, getPressure, getPressureDerivative, MP
+    from component import getNEQ
+from math import exp, log, pi
 import logging
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 from assimulo.problem import Explicit_Problem
 import numpy
-import decimal
 from scipy.special import zetac
 Zeta3 = zetac(3.) + 1.
-decimal.getcontext().prec = 28
 
 
 class BoltzEqs(Explicit_Problem):
@@ -31,6 +33,35 @@ class BoltzEqs(Explicit_Problem):
         Explicit_Problem.__init__(self)
         self.components = compList
 #         self.solver = None
+        nComp = len(compList)
+        self.labels = [comp.label for comp in compList]
+        self.labelIndex = dict([[label,i] for i,label in enumerate(self.labels)])
+        self.isCO = numpy.array([comp.Type == 'CO' for comp in compList])
+        self.isWeakthermal = numpy.array([comp.Type == 'weakthermal' for comp in compList])
+        self.isThermal = numpy.array(['thermal' in comp.Type for comp in compList])
+        self.dofArr = numpy.array([comp.dof for comp in compList],dtype=float)
+#Arrays to store the temperature dependent properties of the components (filled by rhs):
+        self.massArr = numpy.zeros(nComp)
+        self.widthArr = numpy.zeros(nComp)
+        self.BRXArr = numpy.zeros(nComp)
+        self.sourceArr = numpy.zeros(nComp)
+        self.sigVArr = numpy.zeros(nComp)
+        self.nEQArr = numpy.zeros(nComp)
+        self.N2thArr = numpy.zeros((nComp,nComp))  #N2thArr[a,i] = effective thermal density for a -> i + ...
+        self.BeffArr = numpy.zeros((nComp,nComp))  #BeffArr[a,i] = total BR for a -> i + ...
+        self.Tcache = None  #Stores ((x,NS),T) for the values stored in the arrays above
+#Functions used to fill each of the arrays above (the bound methods are built only once):
+        self.TFunctions = [(self.massArr, [comp.mass for comp in compList]),
+                           (self.widthArr, [comp.width for comp in compList]),
+                           (self.BRXArr, [comp.getBRX for comp in compList]),
+                           (self.sourceArr, [comp.getSource for comp in compList]),
+                           (self.sigVArr, [comp.getSIGV for comp in compList])]
+        self.dyArr = numpy.zeros(2*nComp+1)  #Stores the derivatives computed by rhs
+        self.nArr = numpy.zeros(nComp)  #Scratch arrays reused by rhs
+        self.N1thArr = numpy.zeros(nComp)
+        self.RHSArr = numpy.zeros(nComp)
+        self.rhsKey = None  #Stores the (x,y,sw) arguments of the last rhs call
+        self.swCache = {}  #Stores the masks and indices for each configuration of switches
         
         if not x0 is None and not y0 is None: self.updateValues(x0,y0,sw)   #Set initial conditions
 
@@ -51,6 +82,41 @@ class BoltzEqs(Explicit_Problem):
         self.y0.append(yEntropy)
         self.t0 = x
         self.sw0 = sw
+        self.Tcache = None
+
+    def getTValues(self,x,NS):
+        """
+        Computes the temperature at x = log(R/R0) and NS = log(S/S0) and stores the temperature
+        dependent properties of the components in massArr, widthArr, BRXArr, sourceArr, sigVArr and nEQArr.
+        If (x,NS) is the same as in the last call (e.g. when state_events is called after rhs),
+        the stored values are used.
+        :return: the temperature
+        """
+        
+        if self.Tcache and self.Tcache[0] == (x,NS): return self.Tcache[1]
+        T = getTemperature(x,NS)
+        for valArr,funcs in self.TFunctions:
+            for i,func in enumerate(funcs):
+                valArr[i] = func(T)
+        if self.isThermal.any():  #Equilibrium densities for all thermal components at once (zero otherwise)
+            self.nEQArr[self.isThermal] = getNEQ(T,self.massArr[self.isThermal],self.dofArr[self.isThermal])
+        self.Tcache = ((x,NS),T)
+        
+        return T
+
+    def getSwitches(self,sw):
+        """
+        Returns the boolean array of active components, the indices of the active components
+        and the indices of the active non-CO components for the switches sw.
+        The arrays are built only once for each configuration of switches.
+        """
+        
+        key = tuple(sw)
+        if not key in self.swCache:
+            active = numpy.array(sw,dtype=bool)
+            self.swCache[key] = (active,numpy.where(active)[0],numpy.where(active & ~self.isCO)[0])
+        
+        return self.swCache[key]
 
 
     #The right-hand-side function (rhs)
@@ -63,113 +129,227 @@ class BoltzEqs(Explicit_Problem):
         For simplicity we set  R0 = s0 = 1 (with respect to the notes).
         """
 
-        logger.debug('Calling RHS with arguments:\n   x=%s,\n   y=%s\n and switches %s' %(x,y,sw))
-        n = []
-        neq = []
-        rho = []
-        R = []
-        nratio = {'radiation' : 1.}   #n/neq ratio dictionary
+        debug = logger.isEnabledFor(logging.DEBUG)  #Skip the debug calls in the solver loop
+        if debug:
+            logger.debug('Calling RHS with arguments:\n   x=%s,\n   y=%s\n and switches %s',x,y,sw)
+        self.rhsKey = None
+        nComp = len(self.components)
         NS = y[-1]
-        T = getTemperature(x,NS)
-        for i,comp in enumerate(self.components):
-            logger.debug('RHS: Computing component %s' %comp)
-            ni = exp(y[i])
-            Ri = y[i + len(self.components)]
-            if comp.Type == 'CO': rhoi = comp.mass(T)*ni
-            else: rhoi = Ri*ni
-            n.append(ni)
-            neq.append(comp.nEQ(T))            
-            rho.append(rhoi)
-            R.append(Ri)
-            if neq[-1] > 0.: nratio[comp.label] = ni/neq[-1]
-            else: nratio[comp.label] = 0.
-            logger.debug('RHS: Done computing component %s.\n   rho = %s and n = %s' %(comp,rhoi,ni))
+        active, activeIndex, thermalIndex = self.getSwitches(sw)
+#Evaluate the temperature dependent properties of the components only once:
+        T = self.getTValues(x,NS)
+        masses, widths, BRX = self.massArr, self.widthArr, self.BRXArr
+        sources, sigVs, neq = self.sourceArr, self.sigVArr, self.nEQArr
+        y = numpy.asarray(y,dtype=float)
+        n = numpy.exp(y[:nComp],out=self.nArr)
+        R = y[nComp:-1]
+        rho = numpy.where(self.isCO,masses*n,R*n)
+        ratios = numpy.zeros(nComp)
+        hasEQ = neq > 0.
+        with numpy.errstate(over='ignore'):  #neq may be subnormal (ratio -> inf, as for Python floats)
+            ratios[hasEQ] = n[hasEQ]/neq[hasEQ]
+        nratio = {'radiation' : 1.}   #n/neq ratio dictionary
+        nratio.update(zip(self.labels,ratios))
+        if debug:
+            logger.debug('RHS: Computed components.\n   rho = %s and n = %s',rho,n)
         H = Hfunc(T,rho,sw)
        
              
 #Auxiliary weights:
-        logger.debug('Computing weights')     
-        N1th = [0.]*len(self.components)
-        N2th = [0.]*len(self.components)
-        Beff = [0.]*len(self.components)
-        for i,comp in enumerate(self.components):
-            N2th[i] = [0.]*len(self.components)
-            Beff[i] = [0.]*len(self.components)                        
-        for i,comp in enumerate(self.components):
-            N1th[i] = comp.getNTh(T,nratio)
-            for a,compA in enumerate(self.components):                                
-                if a == i or not sw[a]: continue
-                N2th[a][i] = compA.getNTh(T,nratio,comp)
-                Beff[a][i] = compA.getTotalBRTo(T,comp)
-        logger.debug('Done computing weights')
+        N1th = self.N1thArr
+        N2th, Beff = self.N2thArr, self.BeffArr
+        N2th.fill(0.)
+        Beff.fill(0.)
+        for a,compA in enumerate(self.components):
+            N1th[a],BeffA,N2thA = compA.getDecayWeights(T,nratio,self.labels,neq[a])
+            if not active[a]: continue
+            Beff[a] = BeffA  #Weights for a -> i + ... (for all i)
+            N2th[a] = N2thA
+        numpy.fill_diagonal(Beff,0.)
+        numpy.fill_diagonal(N2th,0.)
+        decayTerms = widths*masses*(n - N1th)  #Energy density injected by decays (times H*R)
+        with numpy.errstate(divide='ignore'):  #Inactive components may have R = 0
+            invR = numpy.where(active,1./R,0.)
+#Injection terms (injWeights[a,i] = contribution from the decay a -> i + ..., zero if a is not active):
+        injWeights = (widths*masses)[:,None]*Beff*(n[:,None] - N2th)/H
 # Derivative for entropy:
-        logger.debug('Computing entropy derivative')     
-        dNS = 0.        
-        for i,comp in enumerate(self.components):
-            if not sw[i]: continue
-            dNS += comp.getBRX(T)*comp.width(T)*comp.mass(T)*(n[i]-N1th[i])*exp(3.*x - NS)/(H*T)
-        logger.debug('Done computing entropy derivative')
+        dNS = BRX[active].dot(decayTerms[active])*exp(3.*x - NS)/(H*T)
              
 #Derivatives for the Ni=log(ni/s0) variables:
-        logger.debug('Computing Ni derivatives')
-        dN = [0.]*len(self.components)        
-        for i,comp in enumerate(self.components):
-            if not sw[i]: continue
-            width = comp.width(T)
-            mass = comp.mass(T)
-            RHS = -3.*n[i]     
-            RHS += -width*mass*(n[i] - N1th[i])/(H*R[i])    #Decay term
-            RHS += comp.getSource(T)/H  #Source term
-            annTerm = 0.
-            if comp.Type == 'weakthermal':                
-                nrel = Zeta3*T**3/pi**2
-                annTerm = comp.getSIGV(T)*nrel/H                
-            else:
-                annTerm = comp.getSIGV(T)*n[i]/H
+        RHS = numpy.multiply(-3.,n,out=self.RHSArr)
+        with numpy.errstate(divide='ignore',invalid='ignore'):  #Inactive components may have R = 0
+            RHS -= decayTerms/(H*R)    #Decay term
+        RHS += sources/H  #Source term
+        nrel = Zeta3*T**3/pi**2
+        annTerms = numpy.where(self.isWeakthermal,sigVs*nrel,sigVs*n)/H
+        RHS += annTerms*(neq - n) #Annihilation term
+        for i in activeIndex:
+            comp = self.components[i]
             #Define approximate decoupling temperature (just used for printout)            
-            if annTerm < 1e-2 and not comp.Tdecouple:
+            if annTerms[i] < 1e-2 and not comp.Tdecouple:
                 comp.Tdecouple = T
-            elif annTerm > 1e-2 and comp.Tdecouple:
+            elif annTerms[i] > 1e-2 and comp.Tdecouple:
                 comp.Tdecouple = None  #Reset decoupling temperature if component becomes coupled
-            RHS += annTerm*(neq[i] - n[i]) #Annihilation term
-            for a, compA in enumerate(self.components):
-                if not sw[a]: continue
-                if a == i: continue                                
-                massA = compA.mass(T)
-                widthA = compA.width(T)
-                RHS += widthA*Beff[a][i]*massA*(n[a] - N2th[a][i])/(H*R[a])  #Injection term                       
-            dN[i] = RHS/n[i]    #Log equations
+        injN = invR.dot(injWeights)  #injN[i] = sum_a injWeights[a,i]/R[a]
+        RHS += injN  #Injection term
+        dy = self.dyArr
+        dN = dy[:nComp]
+        with numpy.errstate(divide='ignore',invalid='ignore'):
+            numpy.divide(RHS,n,out=dN)    #Log equations
+        dN[~active] = 0.
         
 
             
 
-        dR = [0.]*len(self.components)
+        dR = dy[nComp:2*nComp]
+        dR.fill(0.)
 #Derivatives for the rho/n variables (only for thermal components):        
-        for i,comp in enumerate(self.components):
-            if not sw[i] or comp.Type == 'CO': continue                 
-            mass = comp.mass(T)
-            RHS = -3.*getPressure(mass,rho[i],n[i])/n[i]  #Cooling term
-            for a, compA in enumerate(self.components):
-                if not sw[a]: continue                
-                if a == i: continue                
-                massA = compA.mass(T)
-                widthA = compA.width(T)
-                RHS += widthA*Beff[a][i]*massA*(1./2. - R[i]/R[a])*(n[a]/n[i] - N2th[a][i]/n[i])/H  #Injection term
-            
+        injR = injWeights.sum(axis=0)/2. - R*injN  #Injection term (times n)
+        for i in thermalIndex:
+            RHS = -3.*getPressure(masses[i],rho[i],n[i])/n[i]  #Cooling term
+            RHS += injR[i]/n[i]  #Injection term
             dR[i] = RHS
 
-        bigerror = False
-        for val in y:
-            if isnan(val) or abs(val) == float('inf'): bigerror = 1     
-        for val in numpy.array(dN + dR + [dNS]):
-            if not bigerror and (isnan(val) or abs(val) == float('inf')): bigerror = 2
-        if bigerror:
-#             os._exit(0)
-            if bigerror == 1:  logger.warning("Right-hand called with NaN values.")
-            if bigerror == 2:  logger.warning("Right-hand side evaluated to NaN.")
+        dy[-1] = dNS
+        self.rhsKey = (x,y.tobytes(),tuple(sw))
+        if not numpy.isfinite(y).all():
+            logger.warning("Right-hand called with NaN values.")
+        elif not numpy.isfinite(dy).all():
+            logger.warning("Right-hand side evaluated to NaN.")
         
-        return numpy.array(dN + dR + [dNS])
+        return dy.copy()  #The solver may keep or modify the returned array
+    
     
+    def jac(self,x,y,sw):
+        """
+        Computes the Jacobian of the right-hand side (d rhs[i]/d y[j]) at point x = log(R/R0).
+        The derivatives with respect to the Ni=log(ni/s0) and Ri=rhoi/ni variables are computed
+        analytically (at fixed temperature). The derivatives with respect to NS=log(S/S0), which
+        enter only through the temperature, are computed numerically.
+        """
+        
+        nComp = len(self.components)
+        J = numpy.zeros((len(y),len(y)))
+        NS = y[-1]
+        active, activeIndex, thermalIndex = self.getSwitches(sw)
+        T = self.getTValues(x,NS)  #Uses the values computed by rhs, if available
+        masses, widths, BRX = self.massArr, self.widthArr, self.BRXArr
+        sources, sigVs, neq = self.sourceArr, self.sigVArr, self.nEQArr
+        yArr = numpy.asarray(y,dtype=float)
+        n = numpy.exp(yArr[:nComp])
+        R = yArr[nComp:-1]
+        rho = numpy.where(self.isCO,masses*n,R*n)
+        ratios = numpy.zeros(nComp)
+        hasEQ = neq > 0.
+        with numpy.errstate(over='ignore'):  #neq may be subnormal (ratio -> inf, as for Python floats)
+            ratios[hasEQ] = n[hasEQ]/neq[hasEQ]
+        nratio = {'radiation' : 1.}   #n/neq ratio dictionary
+        nratio.update(zip(self.labels,ratios))
+        H = Hfunc(T,rho,sw)
+        
+#Derivatives of H with respect to the Ni and Ri variables:
+        dH = numpy.zeros(2*nComp)
+        dH[:nComp] = numpy.where(active,4.*pi*rho/(3.*H*MP**2),0.)
+        dH[nComp:] = numpy.where(active & ~self.isCO,4.*pi*n/(3.*H*MP**2),0.)
+            
+#Auxiliary weights and their derivatives with respect to the Ni variables
+#(dN1th[a,j] = dN1th[a]/dNj and dN2th[a,i,j] = dN2th[a,i]/dNj):
+        N1th = numpy.zeros(nComp)
+        dN1th = numpy.zeros((nComp,nComp))
+        N2th = numpy.zeros((nComp,nComp))
+        dN2th = numpy.zeros((nComp,nComp,nComp))
+        Beff = numpy.zeros((nComp,nComp))
+        for a,compA in enumerate(self.components):
+            N1th[a],BeffA,N2thA,dN1th[a],dN2thA = compA.getDecayWeights(T,nratio,self.labels,
+                                                                        neq[a],derivatives=True)
+            if not active[a]: continue
+            Beff[a] = BeffA  #Weights for a -> i + ... (for all i)
+            N2th[a] = N2thA
+            dN2th[a] = dN2thA
+        numpy.fill_diagonal(Beff,0.)  #The a -> a + ... terms do not contribute
+        N2th[Beff == 0.] = 0.
+        dN2th[Beff == 0.] = 0.
+
+# Derivatives of the entropy equation:
+        for i in activeIndex:
+            wi = BRX[i]*widths[i]*masses[i]*exp(3.*x - NS)/(H*T)
+            J[-1,:nComp] -= wi*dN1th[i]
+            J[-1,i] += wi*n[i]
+            J[-1,:2*nComp] -= wi*(n[i]-N1th[i])*dH/H
+
+#Derivatives of the Ni equations:
+        for i in activeIndex:
+            width = widths[i]
+            mass = masses[i]
+            dRHS = numpy.zeros(2*nComp)
+            RHS = -3.*n[i]
+            dRHS[i] += -3.*n[i]
+            decTerm = -width*mass*(n[i] - N1th[i])/(H*R[i])    #Decay term
+            RHS += decTerm
+            dRHS[:nComp] += width*mass*dN1th[i]/(H*R[i])
+            dRHS[i] += -width*mass*n[i]/(H*R[i])
+            dRHS[:2*nComp] -= decTerm*dH/H
+            dRHS[nComp+i] -= decTerm/R[i]
+            sourceTerm = sources[i]/H  #Source term
+            RHS += sourceTerm
+            dRHS[:2*nComp] -= sourceTerm*dH/H
+            if self.isWeakthermal[i]:                
+                nrel = Zeta3*T**3/pi**2
+                annTerm = sigVs[i]*nrel/H
+                dannTerm = -annTerm*dH/H
+            else:
+                annTerm = sigVs[i]*n[i]/H
+                dannTerm = -annTerm*dH/H
+                dannTerm[i] += annTerm
+            RHS += annTerm*(neq[i] - n[i]) #Annihilation term
+            dRHS += dannTerm*(neq[i] - n[i])
+            dRHS[i] += -annTerm*n[i]
+            for a, compA in enumerate(self.components):
+                if not sw[a] or not Beff[a,i]: continue  #Structural zero (a is inactive or does not decay to i)
+                if a == i: continue                                
+                massA = masses[a]
+                widthA = widths[a]
+                injTerm = widthA*Beff[a,i]*massA*(n[a] - N2th[a,i])/(H*R[a])  #Injection term
+                RHS += injTerm
+                dRHS[:nComp] -= widthA*Beff[a,i]*massA*dN2th[a,i]/(H*R[a])
+                dRHS[a] += widthA*Beff[a,i]*massA*n[a]/(H*R[a])
+                dRHS -= injTerm*dH/H
+                dRHS[nComp+a] -= injTerm/R[a]
+            J[i,:2*nComp] = dRHS/n[i]    #Log equations
+            J[i,i] -= RHS/n[i]
+
+#Derivatives of the Ri equations (only for thermal components):        
+        for i in thermalIndex:
+            mass = masses[i]
+            dRHS = numpy.zeros(2*nComp)
+            dRHS[nComp+i] = -3.*getPressureDerivative(mass,rho[i],n[i])/n[i]  #Cooling term
+            for a, compA in enumerate(self.components):
+                if not sw[a] or not Beff[a,i]: continue  #Structural zero (a is inactive or does not decay to i)
+                if a == i: continue                
+                massA = masses[a]
+                widthA = widths[a]
+                weight = widthA*Beff[a,i]*massA/H
+                nTerm = (n[a]/n[i] - N2th[a,i]/n[i])
+                injTerm = weight*(1./2. - R[i]/R[a])*nTerm  #Injection term
+                dRHS[:nComp] -= weight*(1./2. - R[i]/R[a])*dN2th[a,i]/n[i]
+                dRHS[a] += weight*(1./2. - R[i]/R[a])*n[a]/n[i]
+                dRHS[i] -= injTerm
+                dRHS -= injTerm*dH/H
+                dRHS[nComp+i] -= weight*nTerm/R[a]
+                dRHS[nComp+a] += weight*nTerm*R[i]/R[a]**2
+            J[nComp+i,:2*nComp] = dRHS
+
+#Derivatives with respect to NS (computed numerically, reusing the rhs value
+#if the solver has just evaluated it at the same point):
+        y0 = numpy.array(y,dtype=float)
+        y1 = numpy.array(y,dtype=float)
+        if self.rhsKey == (x,y0.tobytes(),tuple(sw)): f0 = self.dyArr.copy()
+        else: f0 = self.rhs(x,y0,sw)
+        dy = 1.5e-8*max(1.,abs(NS))
+        y1[-1] += dy
+        J[:,-1] = (self.rhs(x,y1,sw) - f0)/dy
+        
+        return J
     
     def state_events(self,x,y,sw):
         """
@@ -180,48 +360,32 @@ class BoltzEqs(Explicit_Problem):
             * a particle has decayed and its number density is effectively zero
             
         The transition vector must be zero when such a transition occurs.
-        Also updates the absolute tolerance of the solver, if the variable's
-        values go below it.
         """
         
-        n = []
-        rho = []
-        for icomp,comp in enumerate(self.components):
-            ni = exp(y[icomp])
-            Ri = y[icomp + len(self.components)]            
-            rhoi = Ri*ni
-            n.append(ni)
-            rho.append(rhoi)
+        nComp = len(self.components)
+        y = numpy.asarray(y,dtype=float)
+        active = self.getSwitches(sw)[0]
+        n = numpy.exp(y[:nComp])
+        rho = y[nComp:-1]*n
         NS = y[-1]
-        T = getTemperature(x,NS)                     
-        transition = [1.]*len(y)
+        T = self.getTValues(x,NS)  #Uses the values computed by rhs, if available
+        transition = numpy.ones(len(y))
                  
          
 #Check if a CO component started oscillating
-        for icomp,comp in enumerate(self.components):
-            if comp.Type != 'CO': continue
-            else: transition[icomp] = Hfunc(T,rho,sw)*3. - comp.mass(T)
+        if self.isCO.any():
+            transition[:nComp] = numpy.where(self.isCO,Hfunc(T,rho,sw)*3. - self.massArr,1.)
             
 #Check if any of the ni components is reaching zero:
-        for icomp,comp in enumerate(self.components):
-            if comp.width(T) == 0. or not sw[icomp]: continue        
-            transition[len(self.components)+icomp] = 2.*y[icomp] + 200.
-
-#Adjust absolute tolerance, so it always respects the relative tolerance:
-        try:
-            for icomp, comp in enumerate(self.components):
-                if not sw[icomp]: continue
-                self.solver.atol[icomp] =  abs(y[icomp])*self.solver.rtol
-                self.solver.atol[icomp+len(self.components)] =  abs(y[icomp+(self.components)])*self.solver.rtol
-            self.solver.atol[-1] =  abs(y[-1])*self.solver.rtol
-        except: pass
+        decaying = active & (self.widthArr != 0.)
+        transition[nComp:2*nComp] = numpy.where(decaying,2.*y[:nComp] + 200.,1.)
                                  
-        return numpy.array(transition)
+        return transition
 
 
     def handle_event(self,solver,event_info):
         """Activate/de-activate components when a discontinuous transition happens\
-        and sets the new initial conditions.\             
+        and sets the new initial conditions.
         Possible discontinuities are: a CO component starts to oscillate, a particle has decayed                 
         """
         
@@ -10,27 +10,43 @@
 
 """
 
-from boltzEqs import BoltzEqs
+try:
+    from .boltzEqs import BoltzEqs
+    from .AuxFuncs import gSTARS, getTemperature, entropyFactor
+except (ImportError, ValueError):  # When imported as a top-level module
+    from boltzEqs import BoltzEqs
+    from AuxFuncs import gSTARS, getTemperature, entropyFactor
 from assimulo.solvers import CVode
-from AuxFuncs import gSTARS, getTemperature
-from math import log,exp,pi
+try:
+    from assimulo.solvers import LSODAR
+except ImportError:  # Assimulo built without ODEPACK
+    LSODAR = None
+from math import log
+import numpy
 import logging
 import random, time
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 random.seed('myseed')
 
 
-def Evolve(compList,T0,TF,omegaErr=0.01):
+def Evolve(compList,T0,TF,omegaErr=0.01,solverType='CVode'):
     """Evolve the components in component list from the re-heat temperature T0 to TF
     For simplicity we set  R0 = s0 = 1 (with respect to the notes).
     Returns a list with components, where the evolveVars hold the evolution of each component.
     The last element of the list is a simple array with the evolution of NS.
     omegaErr is the approximate relative error for Omega h^2.    
+    solverType is the ODE solver used (CVode or LSODAR). LSODAR switches
+    automatically between non-stiff (Adams) and stiff (BDF) methods.
     """
 
 #Sanity checks
     if not goodCompList(compList,T0): return False
+    if not solverType in ['CVode','LSODAR']:
+        logger.error("Unknown solver type %s (must be CVode or LSODAR)" %solverType)
+        return False
+    if solverType == 'LSODAR' and LSODAR is None:
+        logger.error("LSODAR solver not available in the Assimulo installation")
+        return False
     
     t0 = time.time()
 #Compute initial conditions    
@@ -39,7 +55,7 @@ def Evolve(compList,T0,TF,omegaErr=0.01):
     x0 = 0.      # Initial condition for log(R/R0)
     y0 = [comp.evolveVars["N"] for comp in compList]  #Initial conditions for log(n/s0)
     y0 += [comp.evolveVars["R"] for comp in compList] #Initial conditions for log(rho/n)
-    S = (2*pi**2/45)*gSTARS(T0)*T0**3
+    S = entropyFactor*gSTARS(T0)*T0**3
     y0.append(log(S))  #Initial condition for log(S/S0)
     sw = [comp.active for comp in compList]
     logger.info("Initial conditions computed in %s s" %(time.time()-t0))
@@ -51,7 +67,9 @@ def Evolve(compList,T0,TF,omegaErr=0.01):
     rtol = omegaErr
     atol = [omegaErr]*len(y0)    
     boltz_eqs = BoltzEqs(compList,x0,y0,sw) #Define equations and set initial conditions
-    y = mySolve(xf,boltz_eqs,rtol,atol)[1]
+    sol = mySolve(xf,boltz_eqs,rtol,atol,solverType=solverType)
+    if not sol: return False
+    y = sol[1]
     logger.info("First pass at solving Boltzmann equations done in %s s" %(time.time()-t0))
     t0 = time.time()
 #Second call with proper relative/absolute errors
@@ -60,40 +78,56 @@ def Evolve(compList,T0,TF,omegaErr=0.01):
     atol = [omegaErr/2.]*len(compList) + [omegaErr*abs(yy) for yy in y[-1][len(compList):]]
     atol = [max(xx,0.005) for xx in atol]
     boltz_eqs = BoltzEqs(compList,x0,y0,sw) #Define equations and set initial conditions
-    x,y = mySolve(xf,boltz_eqs,rtol,atol,verbosity=50)
+    sol = mySolve(xf,boltz_eqs,rtol,atol,verbosity=50,solverType=solverType)
+    if not sol: return False
+    x,y = sol
     logger.info("Second pass at solving Boltzmann equations done in %s s" %(time.time()-t0))
 #Store the solutions:    
-    for comp in compList: comp.evolveVars = {'T' : [], 'R' : [], 'rho' : [], 'n' : []}
-    for ipt,ypt in enumerate(y):
-        NS = ypt[-1]
-        T = getTemperature(x[ipt],NS)
-        if T < max(10.**(-7),TF): continue     #Do not keep points above TF or after matter domination
-        for icomp,comp in enumerate(compList):        
-            comp.evolveVars['T'].append(T)
-            comp.evolveVars['R'].append(exp(x[ipt]))
-            n = exp(ypt[icomp])
-            if comp.Type == 'CO': rho = n*comp.mass(T)
-            else: rho = n*ypt[icomp + len(compList)]
-            if T < comp.Tdecay or (comp.Type == 'CO' and T > comp.Tosc): n = rho = 0.            
-            comp.evolveVars['rho'].append(rho)
-            comp.evolveVars['n'].append(n)
+    x = numpy.array(x)
+    y = numpy.array(y)
+    Tvalues = getTemperature(x,y[:,-1])  #Temperatures for all points
+    keep = ~(Tvalues < max(10.**(-7),TF))     #Do not keep points above TF or after matter domination
+    Tvalues, Rvalues, y = Tvalues[keep], numpy.exp(x[keep]), y[keep]
+    for icomp,comp in enumerate(compList):
+        n = numpy.exp(y[:,icomp])
+        if comp.Type == 'CO': rho = n*numpy.array([comp.mass(T) for T in Tvalues],dtype=float)
+        else: rho = n*y[:,icomp + len(compList)]
+#Points after the component has decayed or before it started oscillating:
+        vanish = numpy.zeros(len(Tvalues),dtype=bool)
+        if comp.Tdecay is not None: vanish |= Tvalues < comp.Tdecay
+        if comp.Type == 'CO':
+            if comp.Tosc is None: vanish[:] = True
+            else: vanish |= Tvalues > comp.Tosc
+        n[vanish] = rho[vanish] = 0.
+        comp.evolveVars = {'T' : Tvalues.copy(), 'R' : Rvalues.copy(), 'rho' : rho, 'n' : n}
 
     return True
 
         
-def mySolve(xf,boltz_eqs,rtol,atol,verbosity=50):
+def mySolve(xf,boltz_eqs,rtol,atol,verbosity=50,solverType='CVode'):
     """Sets the main options for the ODE solver and solve the equations. Returns the
     array of x,y points for all components.
-    If numerical instabilities are found, re-do the problematic part of the evolution with smaller steps"""
+    If numerical instabilities are found, re-do the problematic part of the evolution with smaller steps
+    solverType sets the Assimulo solver (CVode or LSODAR)"""
         
-    boltz_solver = CVode(boltz_eqs)  #Define solver method
+    if solverType == 'LSODAR':
+        if LSODAR is None:
+            logger.error("LSODAR solver not available in the Assimulo installation")
+            return False
+        boltz_solver = LSODAR(boltz_eqs)  #Automatic stiff/non-stiff switching
+    elif solverType == 'CVode':
+        boltz_solver = CVode(boltz_eqs)  #Define solver method
+        boltz_solver.linear_solver = 'DENSE'
+    else:
+        logger.error("Unknown solver type %s (must be CVode or LSODAR)" %solverType)
+        return False
     boltz_solver.rtol = rtol
     boltz_solver.atol = atol
     boltz_solver.verbosity = verbosity
-    boltz_solver.linear_solver = 'SPGMR'
+    boltz_solver.usejac = True  #Use the (semi-)analytic Jacobian provided by BoltzEqs.jac
     boltz_solver.maxh = xf/300.
     xfinal = xf
-    xres = []
+    xres = []  #Solutions for each successful evolution step (joined at the end)
     yres = []
     sw = boltz_solver.sw[:]
     while xfinal <= xf:
@@ -101,12 +135,12 @@ def mySolve(xf,boltz_eqs,rtol,atol,verbosity=50):
             boltz_solver.re_init(boltz_eqs.t0,boltz_eqs.y0)
             boltz_solver.sw = sw[:]
             x,y = boltz_solver.simulate(xfinal)
-            xres += x
-            for ypt in y: yres.append(ypt)
+            xres.append(numpy.asarray(x,dtype=float))
+            yres.append(numpy.asarray(y,dtype=float))
             if xfinal == xf: break   #Evolution has been performed until xf -> exit            
-        except Exception,e:
-            print e
-            if not e.t or 'first call' in e.msg[e.value]:
+        except Exception as e:
+            print(e)
+            if not getattr(e,'t',None) or 'first call' in str(e):
                 logger.error("Error solving equations:\n "+str(e))
                 return False
             xfinal = max(e.t*random.uniform(0.85,0.95),boltz_eqs.t0+boltz_solver.maxh)  #Try again, but now only until the error
@@ -120,7 +154,7 @@ def mySolve(xf,boltz_eqs,rtol,atol,verbosity=50):
         boltz_eqs.updateValues(x0,y0,sw)
 
     
-    return xres,yres
+    return numpy.concatenate(xres),numpy.concatenate(yres)
                             
                 
 def goodCompList(compList,T0):
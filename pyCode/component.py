@@ -9,10 +9,15 @@
 
 """
 
-from math import exp,log,sqrt,pi
-from AuxDecays import DecayList
+from math import log,sqrt,pi
+try:
+    from .AuxDecays import DecayList
+    from . import AuxFuncs
+except (ImportError, ValueError):  # When imported as a top-level module
+    from AuxDecays import DecayList
+    import AuxFuncs
 from scipy.special import kn,zetac
-import AuxFuncs
+import numpy
 from types import FunctionType
 import logging
 logging.basicConfig(level=logging.INFO)
@@ -23,6 +28,32 @@ Zeta3 = zetac(3.) + 1.
 
 Types = ['thermal','CO', 'weakthermal']
 
+
+def getNEQ(T,mass,dof):
+    """
+    Computes the equilibrium number density (with zero chemical potential) at temperature T
+    for particles with mass mass and dof degrees of freedom (positive/negative for bosons/fermions).
+    T, mass and dof can be arrays (broadcastable), in which case an array is returned.
+    """
+    
+    Ts, masses, dofs = numpy.broadcast_arrays(*[numpy.atleast_1d(numpy.asarray(v,dtype=float))
+                                                 for v in (T,mass,dof)])
+    x = Ts/masses
+    neq = numpy.zeros(x.shape)
+    nonrel = x < 0.1
+    mixed = ~nonrel & (x < 1.5)
+    rel = ~nonrel & ~mixed
+    xn = x[nonrel]
+    neq[nonrel] = masses[nonrel]**3*(xn/(2*pi))**(3./2.)*numpy.exp(-1/xn)*(1. + xn*(15./8. + (105./128.)*xn)) #Non-relativistic (Horner form)
+    xm = x[mixed]
+    neq[mixed] = masses[mixed]**3*xm*kn(2,1/xm)/(2*pi**2) #Non-relativistic/relativistic
+    neq[rel] = numpy.where(dofs[rel] < 0,3./4.,1.)*Zeta3*Ts[rel]**3/pi**2   #Relativistic Fermions/Bosons
+    neq *= numpy.abs(dofs)
+    
+    if neq.size == 1 and not numpy.ndim(T) and not numpy.ndim(mass) and not numpy.ndim(dof):
+        return float(neq[0])
+    return neq
+
 class Component(object):
     """Main class to hold component properties.
     
@@ -47,6 +78,7 @@ class Component(object):
         self.Tosc = None
         self.Tdecouple = None
         self.evolveVars = {"R" : None, "N": None, "x" : None}
+        self.Tcache = {}  #Stores the last (T,value) computed by getBRs and nEQ (and the decay multiplicities)
 
         if not Type or type(Type) != type(str()) or not Type in Types:
             logger.error("Please define proper particle Type (not "+str(Type)+"). \n Possible Types are: "+str(Types))
@@ -56,7 +88,8 @@ class Component(object):
         if isinstance(mass,FunctionType):
             self.mass = mass #Use function given
         elif isinstance(mass,int) or isinstance(mass,float):
-            self.mass = lambda T: float(mass)  #Use value given for all T
+            massValue = float(mass)  #Convert only once
+            self.mass = lambda T: massValue  #Use value given for all T
         else:
             logger.error("Mass must be a number or a function of T")
             return False
@@ -75,7 +108,8 @@ class Component(object):
         if isinstance(sigmav,FunctionType):
             self.sigmav = sigmav #Use function given
         elif isinstance(sigmav,int) or isinstance(sigmav,float):
-            self.sigmav = lambda T: float(sigmav)  #Use value given for all T
+            sigmavValue = float(sigmav)  #Convert only once
+            self.sigmav = lambda T: sigmavValue  #Use value given for all T
         else:
             logger.error("sigmav must be a number or a function of T")
             return False
@@ -84,7 +118,8 @@ class Component(object):
         if isinstance(source,FunctionType):
             self.source = source #Use function given
         elif isinstance(source,int) or isinstance(source,float):
-            self.source = lambda T: float(source)  #Use value given for all T
+            sourceValue = float(source)  #Convert only once
+            self.source = lambda T: sourceValue  #Use value given for all T
         else:
             logger.error("source must be a number or a function of T")
             return False
@@ -93,7 +128,8 @@ class Component(object):
         if isinstance(coherentAmplitute,FunctionType):
             self.coherentAmplitute = coherentAmplitute #Use function given
         elif isinstance(coherentAmplitute,int) or isinstance(coherentAmplitute,float):
-            self.coherentAmplitute = lambda T: float(coherentAmplitute)  #Use value given for all T
+            coherentAmplituteValue = float(coherentAmplitute)  #Convert only once
+            self.coherentAmplitute = lambda T: coherentAmplituteValue  #Use value given for all T
         else:
             logger.error("coherentAmplitute must be a number or a function of T")
             return False
@@ -104,10 +140,15 @@ class Component(object):
 
     def getBRs(self,T):
         """
-        Get the decays for a given temperature T
+        Get the decays for a given temperature T.
+        The result for the last temperature is cached, since it is used by several methods.
         """
 
-        return self.decays(T) 
+        cached = self.Tcache.get('BRs')
+        if cached is None or cached[0] != T:
+            cached = (T,self.decays(T))
+            self.Tcache['BRs'] = cached
+        return cached[1]
 
     def getBRX(self,T):
         """
@@ -136,6 +177,86 @@ class Component(object):
         return brTot
             
 
+    def getDecayMultiplicities(self,T,labels):
+        """
+        Computes the multiplicities of the final state particles for each decay
+        and the total branching ratios to each component in labels (see getTotalBRTo).
+        The result only depends on the decays, so it is kept until getBRs returns a different object 
+        (for decays which do not depend on T it is computed only once).
+        
+        :param labels: list with the labels of the components
+        :return: list with the labels of all final states (starting with labels),
+                 multiplicity matrix (multiplicity[idecay,istate]), array with the BR of each decay and
+                 array with the total BRs for each label
+        """
+        
+        BRs = self.getBRs(T)
+        cached = self.Tcache.get('multiplicities')
+        if cached is None or cached[0] is not BRs or cached[1] != labels:
+            decays = list(BRs)
+            states = list(labels)
+            for decay in decays:
+                states += sorted(set(decay.fstateIDs).difference(states))
+            multiplicity = numpy.array([[decay.fstateIDs.count(label) for label in states]
+                                        for decay in decays],dtype=float).reshape(len(decays),len(states))
+            brs = numpy.array([decay.br for decay in decays],dtype=float)
+            brTot = brs.dot(multiplicity[:,:len(labels)])
+            cached = (BRs,list(labels),states,multiplicity,brs,brTot)
+            self.Tcache['multiplicities'] = cached
+        
+        return cached[2:]
+
+    def getDecayWeights(self,T,nratio,labels,neq=None,derivatives=False):
+        """
+        Computes getNTh(T,nratio) and, for all the components in labels, getTotalBRTo(T,comp)
+        and getNTh(T,nratio,comp) at once, using the multiplicity matrix of the decays
+        (see getDecayMultiplicities) and evaluating the decays and the equilibrium
+        number density only once.
+        
+        :param T: temperature (allows for T-dependent BRs)
+        :param nratio: Dictionary with ratios of number density to the equilibrium number density.
+        :param labels: list with the labels of the components
+        :param neq: equilibrium number density at T (computed with nEQ, if not given)
+        :param derivatives: if True, also returns the derivatives of the effective thermal number densities
+                            with respect to log(n[a]) for each label a
+        :return: effective thermal number density (float), array with the total BRs and
+                 array with the effective thermal number densities for each label.
+                 If derivatives = True, also returns the array dNth[a] = dNth/dlog(n[a]) and the
+                 matrix dNthTo[j,a] = dNthTo[j]/dlog(n[a]).
+        """
+        
+        states,multiplicity,brs,brTot = self.getDecayMultiplicities(T,labels)
+        nLabels = len(labels)
+        NthTo = numpy.zeros(nLabels)
+        if neq is None: neq = self.nEQ(T)
+        if not neq or not len(brs):
+            if derivatives: return 0.,brTot.copy(),NthTo,numpy.zeros(nLabels),numpy.zeros((nLabels,nLabels))
+            return 0.,brTot.copy(),NthTo
+        defined = numpy.array([label in nratio for label in states])
+        ratios = numpy.array([nratio.get(label,1.) for label in states],dtype=float)
+#Ignore decays with zero BRs or with particles not defined (or with zero ratios, whose weights vanish):
+        vanish = ~defined | (ratios == 0.)
+        use = (brs != 0.) & ~(multiplicity[:,vanish] > 0.).any(axis=1)
+#Compute neq*br*prod(ratios**multiplicity) in log space, since neq may be tiny and the ratios large:
+        logRatios = numpy.log(numpy.where(vanish,1.,ratios))
+        with numpy.errstate(divide='ignore',over='ignore'):
+            logWeights = numpy.log(neq*brs) + multiplicity.dot(logRatios)
+            weights = numpy.where(use,numpy.exp(numpy.where(use,logWeights,0.)),0.)
+        Nth = float(weights.sum())
+        M = multiplicity[:,:nLabels]
+        NthTo = weights.dot(M)
+        
+        nonzero = NthTo > 0.
+        NthTo[nonzero] /= brTot[nonzero]
+        if not derivatives: return Nth,brTot.copy(),NthTo
+        
+#dNth/dlog(n[a]) = sum_d M[d,a]*w_d and dNthTo[j]/dlog(n[a]) = sum_d M[d,j]*M[d,a]*w_d/brTot[j]:
+        dNth = weights.dot(M)
+        dNthTo = (M*weights[:,None]).T.dot(M)
+        norm = brTot > 0.
+        dNthTo[norm] /= brTot[norm][:,None]
+        return Nth,brTot.copy(),NthTo,dNth,dNthTo
+
     def getNTh(self,T,nratio,comp=None):
         """        
         Computes the effective thermal number density at temperature T:
@@ -185,21 +306,16 @@ class Component(object):
         return self.source(T)
         
     def nEQ(self,T):
-        """Returns the equilibrium number density at temperature T. Returns zero for non-thermal components"""
+        """Returns the equilibrium number density at temperature T. Returns zero for non-thermal components.
+        The result for the last temperature is cached."""
         
+        cached = self.Tcache.get('nEQ')
+        if cached is not None and cached[0] == T: return cached[1]
         if not 'thermal' in self.Type:
             return 0.
         
-        x = T/self.mass(T)       
-        if x < 0.1:
-            neq = self.mass(T)**3*(x/(2*pi))**(3./2.)*exp(-1/x)*(1. + (15./8.)*x + (105./128.)*x**2) #Non-relativistic
-        elif x < 1.5:            
-            neq = self.mass(T)**3*x*kn(2,1/x)/(2*pi**2) #Non-relativistic/relativistic
-        else:
-            if self.dof > 0: neq = Zeta3*T**3/pi**2   #Relativistic Bosons
-            if self.dof < 0: neq = (3./4.)*Zeta3*T**3/pi**2   #Relativistic Fermions
-            
-        neq = neq*abs(self.dof)
+        neq = getNEQ(T,self.mass(T),self.dof)
+        self.Tcache['nEQ'] = (T,neq)
         return neq
     
     def rEQ(self,T):
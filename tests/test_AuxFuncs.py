@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+"""
+Checks the auxiliary functions (g*, interpolation, relic density and output parsing) against
+direct calculations with scipy.
+"""
+
+import os,sys
+import unittest
+import warnings
+import tempfile, shutil, pickle
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from math import exp,log,sqrt
+import numpy
+from scipy import integrate, interpolate
+
+from pyCode import AuxFuncs
+from pyCode.component import Component
+
+
+class AuxFuncsTest(unittest.TestCase):
+
+    def setUp(self):
+        #The test runner resets the warnings filters, while the modules turn warnings into errors:
+        self.warnings = warnings.catch_warnings()
+        self.warnings.__enter__()
+        warnings.simplefilter('error')
+
+    def tearDown(self):
+        self.warnings.__exit__(None,None,None)
+
+    def testGstarFunc(self):
+        """Compare the Gauss-Legendre integration with quad (in y, as in the original romberg integration)."""
+
+        for x in [0.011,0.1,0.5,1.,3.,10.,19.]:
+            for dof in [1,-2]:
+                ep = -numpy.sign(dof)
+                a, b = 0.01, (1./x)*(1. - 0.01/100.)
+                res = integrate.quad(lambda y: sqrt(1. - y**2*x**2)/(y**5*(exp(1./y) + ep)),a,b,
+                                     epsabs=0.,epsrel=1e-10,limit=200)[0]
+                res *= abs(dof)*0.15399
+                self.assertAlmostEqual(AuxFuncs.gstarFunc(x,dof)/res,1.,delta=1e-4)
+        #Limits and array input:
+        self.assertEqual(AuxFuncs.gstarFunc(25.,1),0.)
+        self.assertAlmostEqual(AuxFuncs.gstarFunc(1e-3,-2),2*5.6822*0.15399)
+        xs, dofs = numpy.array([1e-3,0.5,5.,30.]), numpy.array([1,-2,3,-1])
+        vals = AuxFuncs.gstarFunc(xs,dofs)
+        for x,dof,val in zip(xs,dofs,vals):
+            self.assertAlmostEqual(AuxFuncs.gstarFunc(x,dof),val,places=12)
+
+    def testInterpolation(self):
+        """Compare with scipy's interp1d, including the boundary conditions and pickling."""
+
+        xi = numpy.array([3.,0.,1.,2.5,5.])
+        yi = numpy.array([1.,-1.,2.,0.5,4.])
+        xnew = numpy.linspace(-2.,7.,37)
+        inside = (xnew >= 0.) & (xnew <= 5.)
+        f = AuxFuncs.interp1d_picklable(xi,yi)
+        fref = interpolate.interp1d(xi,yi)
+        numpy.testing.assert_allclose(f(xnew[inside]),fref(xnew[inside]),rtol=1e-14)
+        self.assertEqual(f(-1.),-1.)  #End point values outside the range
+        self.assertEqual(f(6.),4.)
+        for fill_value in ['extrapolate',(-10.,10.)]:
+            f = AuxFuncs.interp1d_picklable(xi,yi,fill_value=fill_value)
+            fref = interpolate.interp1d(xi,yi,fill_value=fill_value,bounds_error=False)
+            numpy.testing.assert_allclose(f(xnew),fref(xnew),rtol=1e-14)
+            fpickled = pickle.loads(pickle.dumps(f))
+            numpy.testing.assert_array_equal(fpickled(xnew),f(xnew))
+
+    def testGetOmega(self):
+        """Compare the RK4 solution for R = rho/n with a tight tolerance odeint solution."""
+
+        T, n = 1e-3, 1e-15
+        for mass in [1e-12,1e-11,1e-9]:
+            comp = Component(label='DM',Type='thermal',dof=1,mass=mass)
+            rho = 3.15*T*n  #Relativistic at T
+            Ttoday = 2.3697*10**(-13)*2.725/2.75
+            dx = (1./3.)*log(AuxFuncs.gSTARS(T)/AuxFuncs.gSTARS(Ttoday)) + log(T/Ttoday)
+            def Rfunc(R,x):
+                nF = n*exp(-3*x)
+                return -3*AuxFuncs.getPressure(mass,float(R[0])*nF,nF)/nF
+            RToday = integrate.odeint(Rfunc,rho/n,[0.,24.],rtol=1e-11,atol=1e-30)[1][0]
+            omegaRef = RToday*n*exp(-3.*dx)/8.0992e-47
+            omega = AuxFuncs.getOmega(comp,rho,n,T)
+            self.assertAlmostEqual(omega/omegaRef,1.,delta=1e-5)
+
+    def testGetDataFrom(self):
+        """Read back the parameters and data written by printParameters and printData."""
+
+        tmpDir = tempfile.mkdtemp()
+        try:
+            comp = Component(label='DM',Type='thermal',dof=1,mass=100.)
+            Tvalues = numpy.array([100.,10.,1.])
+            comp.evolveVars = {'T' : Tvalues, 'R' : 1./Tvalues, 'n' : Tvalues**3, 'rho' : 100.*Tvalues**3}
+            outFile = os.path.join(tmpDir,'output.dat')
+            AuxFuncs.printParameters([('mass','100.'),('label','DM')],outFile)
+            AuxFuncs.printData([comp],outFile)
+            parDict,summaryDict,dataDict = AuxFuncs.getDataFrom(outFile)
+            self.assertEqual(parDict,{'mass' : 100., 'label' : 'DM'})
+            self.assertEqual(summaryDict,{})
+            self.assertEqual(sorted(dataDict.keys()),sorted(['R','T (GeV)','n_{DM} (GeV^{3})','#rho_{DM} (GeV^{2})']))
+            numpy.testing.assert_allclose(dataDict['T (GeV)'],Tvalues,rtol=1e-4)
+            numpy.testing.assert_allclose(dataDict['#rho_{DM} (GeV^{2})'],100.*Tvalues**3,rtol=1e-4)
+            #Header without data points:
+            comp.evolveVars = dict([[key,val[:0]] for key,val in comp.evolveVars.items()])
+            emptyFile = os.path.join(tmpDir,'empty.dat')
+            AuxFuncs.printData([comp],emptyFile)
+            dataDict = AuxFuncs.getDataFrom(emptyFile)[2]
+            self.assertEqual(len(dataDict),4)
+            for val in dataDict.values(): self.assertEqual(val.shape,(0,))
+        finally:
+            shutil.rmtree(tmpDir)
+
+
+if __name__ == "__main__":
+    unittest.main()
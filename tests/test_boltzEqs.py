@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+"""
+Checks the right-hand side of the Boltzmann equations in extreme (but physical) regimes.
+"""
+
+import os,sys
+import unittest
+import warnings
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from math import log
+import numpy
+
+try:
+    from pyCode.boltzEqs import BoltzEqs
+    from pyCode.component import Component
+    from pyCode import AuxFuncs
+except ImportError:  # Assimulo is not installed
+    BoltzEqs = None
+
+
+@unittest.skipIf(BoltzEqs is None, "Assimulo is not installed")
+class SubnormalNEQTest(unittest.TestCase):
+
+    def setUp(self):
+        #The test runner resets the warnings filters, while the modules turn warnings into errors:
+        self.warnings = warnings.catch_warnings()
+        self.warnings.__enter__()
+        warnings.simplefilter('error')
+
+    def tearDown(self):
+        self.warnings.__exit__(None,None,None)
+
+    def testFreezeOut(self):
+        """A frozen-out relic at T ~ m/740, where its equilibrium density is subnormal."""
+
+        T = 0.1345
+        dm = Component(label='DM',Type='thermal',dof=1,mass=100.,sigmav=1e-9)
+        neq = dm.nEQ(T)
+        self.assertTrue(0. < neq < numpy.finfo(float).tiny)
+        S = AuxFuncs.entropyFactor*AuxFuncs.gSTARS(T)*T**3
+        y = [log(1e-12*S),100.,log(S)]
+        boltz_eqs = BoltzEqs([dm])
+        self.assertAlmostEqual(AuxFuncs.getTemperature(0.,y[-1])/T,1.,places=3)
+        dy = boltz_eqs.rhs(0.,y,[True])
+        self.assertTrue(numpy.isfinite(dy).all())
+        #Annihilations are negligible, so n only dilutes (dN/dx = -3) and entropy is conserved:
+        self.assertAlmostEqual(dy[0],-3.,places=2)
+        self.assertEqual(dy[-1],0.)
+        J = boltz_eqs.jac(0.,y,[True])
+        self.assertTrue(numpy.isfinite(J).all())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+"""
+Checks the component properties (equilibrium densities and decay weights) against direct calculations.
+"""
+
+import os,sys
+import unittest
+import warnings
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import numpy
+from scipy import integrate, special
+
+from pyCode.component import Component, getNEQ
+from pyCode.AuxDecays import DecayList, Decay
+
+
+def mediatorDecays(T):
+    decays = DecayList()
+    decays.addDecay(Decay(instate='Mediator',fstates=['DM','radiation'],br=0.7))
+    decays.addDecay(Decay(instate='Mediator',fstates=['DM','DM'],br=0.3))
+    decays.Xfraction = 0.5
+    decays.width = 1e-14
+    return decays
+
+def getComponents():
+    dm = Component(label='DM',Type='thermal',dof=1,mass=100.,sigmav=1e-9)
+    mediator = Component(label='Mediator',Type='thermal',dof=-2,mass=500.,
+                         decays=mediatorDecays,sigmav=1e-8)
+    return [dm,mediator]
+
+def getNThLoop(comp,T,nratio,daughter=None):
+    """Direct evaluation of the effective thermal number density, multiplying neq in first."""
+
+    Nth = norm = 0.
+    for decay in comp.getBRs(T):
+        if daughter is not None and not daughter in decay.fstateIDs: continue
+        nprod = comp.nEQ(T)*decay.br
+        for label in decay.fstateIDs:
+            nprod *= nratio[label]
+        if daughter is None:
+            Nth += nprod
+        else:
+            Nth += decay.fstateIDs.count(daughter)*nprod
+            norm += decay.fstateIDs.count(daughter)*decay.br
+    if daughter is None: return Nth
+    return Nth/norm
+
+
+class ComponentTest(unittest.TestCase):
+
+    def setUp(self):
+        #The test runner resets the warnings filters, while the modules turn warnings into errors:
+        self.warnings = warnings.catch_warnings()
+        self.warnings.__enter__()
+        warnings.simplefilter('error')
+
+    def tearDown(self):
+        self.warnings.__exit__(None,None,None)
+
+    def testLargeDaughterRatio(self):
+        """A parent with a tiny neq decaying to a daughter far above equilibrium."""
+
+        dm,mediator = getComponents()
+        T = 0.833
+        neq = mediator.nEQ(T)
+        self.assertTrue(0. < neq < 1e-250)
+        nratio = {'radiation' : 1., 'DM' : 1e160, 'Mediator' : 1.}
+        Nth,brTot,NthTo = mediator.getDecayWeights(T,nratio,['DM','Mediator'])
+        self.assertTrue(numpy.isfinite(Nth) and Nth > 1e60)
+        self.assertAlmostEqual(Nth/getNThLoop(mediator,T,nratio),1.,places=10)
+        self.assertAlmostEqual(NthTo[0]/getNThLoop(mediator,T,nratio,'DM'),1.,places=10)
+        self.assertAlmostEqual(brTot[0],1.3)
+        self.assertEqual(NthTo[1],0.)
+
+    def testNEQ(self):
+        """Compare getNEQ with the Maxwell-Boltzmann and relativistic limits."""
+
+        mass = 100.
+        for x in [0.01,0.05,0.09,0.2,1.,1.4]:
+            T = x*mass
+            #Maxwell-Boltzmann density (exact for x < 1.5, up to the expansion used for x < 0.1):
+            nMB = 2.*mass**2*T*special.kn(2,mass/T)/(2.*numpy.pi**2)
+            self.assertAlmostEqual(getNEQ(T,mass,2)/nMB,1.,delta=2e-4)
+            self.assertAlmostEqual(getNEQ(T,mass,-2)/nMB,1.,delta=2e-4)
+        #Relativistic limit (T > 1.5*mass):
+        T = 1000.
+        nB = integrate.quad(lambda p: p**2/(numpy.exp(p/T) - 1.),0.,50.*T,epsrel=1e-10)[0]/(2.*numpy.pi**2)
+        nF = integrate.quad(lambda p: p**2/(numpy.exp(p/T) + 1.),0.,50.*T,epsrel=1e-10)[0]/(2.*numpy.pi**2)
+        self.assertAlmostEqual(getNEQ(T,1.,3)/(3.*nB),1.,places=8)
+        self.assertAlmostEqual(getNEQ(T,1.,-2)/(2.*nF),1.,places=8)
+        #Array input and the component method:
+        Ts = numpy.array([0.5,10.,100.,1e3])
+        neqs = getNEQ(Ts,mass,2)
+        dm = getComponents()[0]
+        for T,neq in zip(Ts,neqs):
+            self.assertEqual(getNEQ(T,mass,2),neq)
+            self.assertEqual(dm.nEQ(T),getNEQ(T,dm.mass(T),dm.dof))
+        self.assertEqual(getNEQ(1e-3,mass,2),0.)
+
+    def testDecayWeights(self):
+        """Compare the matrix evaluation of the decay weights and their derivatives with a loop over the decays."""
+
+        dm,mediator = getComponents()
+        labels = ['DM','Mediator']
+        T = 80.
+        states,multiplicity,brs,brTot = mediator.getDecayMultiplicities(T,labels)
+        self.assertEqual(states,['DM','Mediator','radiation'])
+        numpy.testing.assert_array_equal(multiplicity,[[1.,0.,1.],[2.,0.,0.]])
+        numpy.testing.assert_allclose(brs,[0.7,0.3])
+        numpy.testing.assert_allclose(brTot,[1.3,0.])
+        for ratioDM in [0.,1e-3,1.,25.]:
+            nratio = {'radiation' : 1., 'DM' : ratioDM, 'Mediator' : 2.}
+            Nth,brTot,NthTo,dNth,dNthTo = mediator.getDecayWeights(T,nratio,labels,derivatives=True)
+            self.assertAlmostEqual(Nth,getNThLoop(mediator,T,nratio),delta=1e-12*abs(Nth))
+            self.assertAlmostEqual(NthTo[0],getNThLoop(mediator,T,nratio,'DM'),delta=1e-12*abs(NthTo[0]))
+            self.assertEqual(NthTo[1],0.)
+            #Derivatives with respect to log(n_DM) (Nth is a polynomial in ratioDM):
+            neq = mediator.nEQ(T)
+            self.assertAlmostEqual(dNth[0],neq*(0.7*ratioDM + 2.*0.3*ratioDM**2),delta=1e-12*neq)
+            self.assertAlmostEqual(dNthTo[0,0],neq*(0.7*ratioDM + 4.*0.3*ratioDM**2)/1.3,delta=1e-12*neq)
+            self.assertEqual(dNth[1],0.)
+            self.assertEqual(dNthTo[0,1],0.)
+        #Undefined labels are ignored:
+        Nth = mediator.getDecayWeights(T,{'radiation' : 1., 'Mediator' : 2.},labels)[0]
+        self.assertEqual(Nth,0.)
+        self.assertEqual(dm.getDecayWeights(T,nratio,labels,derivatives=True)[0],0.)
+
+
+if __name__ == "__main__":
+    unittest.main()
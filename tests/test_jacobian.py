@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+"""
+Checks the analytical Jacobian (BoltzEqs.jac) against central differences of BoltzEqs.rhs.
+"""
+
+import os,sys
+import unittest
+import warnings
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import numpy
+
+try:
+    from pyCode.boltzEqs import BoltzEqs
+    from pyCode.component import Component
+    from pyCode.AuxDecays import DecayList, Decay
+except ImportError:  # Assimulo is not installed
+    BoltzEqs = None
+
+
+def mediatorDecays(T):
+    decays = DecayList()
+    decays.addDecay(Decay(instate='Mediator',fstates=['DM','radiation'],br=0.7))
+    decays.addDecay(Decay(instate='Mediator',fstates=['DM','DM'],br=0.3))
+    decays.Xfraction = 0.5
+    decays.width = 1e-14*(1. + 0.01/(1. + T))
+    return decays
+
+def heavyDecays(T):
+    decays = DecayList()
+    decays.addDecay(Decay(instate='Heavy',fstates=['Mediator','radiation'],br=0.6))
+    decays.addDecay(Decay(instate='Heavy',fstates=['DM','Mediator'],br=0.4))
+    decays.Xfraction = 0.3
+    decays.width = 1e-10
+    return decays
+
+def axionDecays(T):
+    decays = DecayList()
+    decays.addDecay(Decay(instate='Axion',fstates=['radiation','radiation'],br=1.))
+    decays.Xfraction = 1.
+    decays.width = 1e-25
+    return decays
+
+def getComponents():
+    """Returns a list of components with thermal, weakly thermal and coherent oscillations types."""
+
+    dm = Component(label='DM',Type='thermal',dof=1,mass=100.,sigmav=lambda T: 1e-9*(1. + T*1e-3))
+    mediator = Component(label='Mediator',Type='thermal',dof=-2,mass=500.,
+                         decays=mediatorDecays,sigmav=lambda T: 1e-8)
+    heavy = Component(label='Heavy',Type='weakthermal',dof=2,mass=2000.,decays=heavyDecays,
+                      sigmav=1e-12,source=lambda T: 1e-3*T**4)
+    axion = Component(label='Axion',Type='CO',dof=1,mass=lambda T: 1e-3*(1. + 1./(1. + T)),
+                      decays=axionDecays,coherentAmplitute=lambda T: 1e5)
+    return [dm,mediator,heavy,axion]
+
+
+@unittest.skipIf(BoltzEqs is None, "Assimulo is not installed")
+class JacobianTest(unittest.TestCase):
+
+    def setUp(self):
+        #The test runner resets the warnings filters, while the modules turn warnings into errors:
+        self.warnings = warnings.catch_warnings()
+        self.warnings.__enter__()
+        warnings.simplefilter('error')
+
+    def tearDown(self):
+        self.warnings.__exit__(None,None,None)
+
+    def compare(self,x,y,sw):
+        boltz_eqs = BoltzEqs(getComponents())
+        J = boltz_eqs.jac(x,y,sw)
+        f0 = numpy.abs(boltz_eqs.rhs(x,y,sw))
+        Jnum = numpy.zeros(J.shape)
+        for k in range(len(y)):
+            h = 1e-6*max(1.,abs(y[k]))
+            yp = numpy.array(y,dtype=float)
+            ym = numpy.array(y,dtype=float)
+            yp[k] += h
+            ym[k] -= h
+            Jnum[:,k] = (boltz_eqs.rhs(x,yp,sw) - boltz_eqs.rhs(x,ym,sw))/(2.*h)
+        scale = numpy.abs(J).max(axis=1) + numpy.abs(Jnum).max(axis=1) + f0 + 1e-300
+        err = numpy.abs(J - Jnum)/scale[:,None]
+        #The NS column is itself computed numerically by jac:
+        self.assertLess(err[:,:-1].max(),1e-5)
+        self.assertLess(err[:,-1].max(),1e-3)
+
+    def testJacobian(self):
+        nComp = 4
+        for itrial in range(10):
+            rng = numpy.random.RandomState(itrial)
+            if itrial % 3: sw = [bool(s) for s in rng.randint(0,2,nComp)]
+            else: sw = [True]*nComp
+            x = rng.uniform(0.,15.)
+            N = numpy.log(rng.uniform(1e3,1e8,nComp))
+            R = numpy.array([comp.mass(1.)*rng.uniform(1.,20.) for comp in getComponents()])
+            NS = 30. + rng.uniform(-1.,1.)
+            y = numpy.hstack((N,R,[NS]))
+            self.compare(x,y,sw)
+
+
+if __name__ == "__main__":
+    unittest.main()